@@ -1,16 +1,19 @@
 import tempfile
+import uuid
+import warnings
 import zipfile
+from datetime import datetime
 from io import BytesIO
 from pathlib import Path
-from shutil import copyfile, copytree
+from shutil import copytree
 
 import geopandas as gpd
+import numpy as np
 import polars as pl
 import xarray as xr
 from openhexa.sdk import Dataset, current_run, parameter, pipeline, workspace
 from openhexa.sdk.datasets import DatasetFile
 from openhexa.toolbox.era5.aggregate import (
-    aggregate,
     aggregate_per_month,
     aggregate_per_week,
     build_masks,
@@ -19,6 +22,30 @@ from openhexa.toolbox.era5.aggregate import (
 )
 from openhexa.toolbox.era5.cds import VARIABLES
 
+# additional zonal statistics that can be computed alongside mean, min and max
+STATISTICS = ["std", "median", "p10", "p25", "p75", "p90", "count"]
+
+# max. size of the dense (boundaries x cells) matrix built when computing zonal statistics
+MAX_CHUNK_BYTES = 64 * 1024**2
+
+# period column of the aggregated dataframes for each temporal aggregation
+# (aggregate_per_week() names the period column "week" for epi. weeks too)
+PERIOD_COLUMNS = {"weekly": "week", "epi_weekly": "week", "monthly": "month"}
+
+# index of grib messages available in raw data files, persisted in the input directory
+GRIB_INDEX = ".grib_index.parquet"
+GRIB_INDEX_SCHEMA = {
+    "file": pl.String,
+    "size": pl.Int64,
+    "mtime": pl.Int64,
+    "offset": pl.Int64,
+    "length": pl.Int64,
+    "short_name": pl.String,
+    "grid": pl.String,
+    "valid_time": pl.Datetime,
+    "expver": pl.String,
+}
+
 
 @pipeline("__pipeline_id__", name="ERA5 Aggregate")
 @parameter(
@@ -58,12 +85,30 @@ from openhexa.toolbox.era5.cds import VARIABLES
     required=True,
     default="id",
 )
+@parameter(
+    "statistics",
+    name="Additional statistics",
+    type=str,
+    multiple=True,
+    choices=STATISTICS,
+    help="Zonal statistics to compute in addition to mean, min and max",
+    required=False,
+)
+@parameter(
+    "compute_anomalies",
+    name="Compute anomalies",
+    type=bool,
+    help="Maintain a climatology per boundary and period of year and write anomalies",
+    default=False,
+)
 def era5_aggregate(
     input_dir: str,
     output_dir: str,
     boundaries_dataset: Dataset,
     boundaries_column_uid: str,
     boundaries_file: str | None = None,
+    statistics: list[str] | None = None,
+    compute_anomalies: bool = False,
 ):
     input_dir = Path(workspace.files_path, input_dir)
     output_dir = Path(workspace.files_path, output_dir)
@@ -79,12 +124,15 @@ def era5_aggregate(
         current_run.log_error(msg)
         raise FileNotFoundError(msg)
 
+    statistics = [stat for stat in STATISTICS if stat in (statistics or [])]
+
     for variable in variables:
         daily = get_daily(
             input_dir=input_dir / variable,
             boundaries=boundaries,
             variable=variable,
             column_uid=boundaries_column_uid,
+            statistics=statistics,
         )
 
         current_run.log_info(
@@ -100,6 +148,12 @@ def era5_aggregate(
             use_epidemiological_weeks=False,
             sum_aggregation=sum_aggregation,
         )
+        weekly = carry_statistics(
+            daily=daily,
+            aggregated=weekly,
+            statistics=statistics,
+            period_column="week",
+        )
 
         current_run.log_info(
             f"Applied weekly aggregation to {variable} data ({len(weekly)} rows)"
@@ -111,6 +165,12 @@ def era5_aggregate(
             use_epidemiological_weeks=True,
             sum_aggregation=sum_aggregation,
         )
+        epi_weekly = carry_statistics(
+            daily=daily,
+            aggregated=epi_weekly,
+            statistics=statistics,
+            period_column="epi_week",
+        )
 
         current_run.log_info(
             f"Applied epi. weekly aggregation to {variable} data ({len(epi_weekly)} rows)"
@@ -121,6 +181,12 @@ def era5_aggregate(
             column_uid="boundary_id",
             sum_aggregation=sum_aggregation,
         )
+        monthly = carry_statistics(
+            daily=daily,
+            aggregated=monthly,
+            statistics=statistics,
+            period_column="month",
+        )
 
         current_run.log_info(
             f"Applied monthly aggregation to {variable} data ({len(monthly)} rows)"
@@ -129,6 +195,39 @@ def era5_aggregate(
         dst_dir = output_dir / variable
         dst_dir.mkdir(parents=True, exist_ok=True)
 
+        if compute_anomalies:
+            climatology = update_climatology(
+                aggregated=weekly,
+                frequency="weekly",
+                cache_dir=dst_dir / "climatology",
+                variable=variable,
+            )
+            weekly = add_anomalies(
+                aggregated=weekly, climatology=climatology, frequency="weekly"
+            )
+
+            climatology = update_climatology(
+                aggregated=epi_weekly,
+                frequency="epi_weekly",
+                cache_dir=dst_dir / "climatology",
+                variable=variable,
+            )
+            epi_weekly = add_anomalies(
+                aggregated=epi_weekly, climatology=climatology, frequency="epi_weekly"
+            )
+
+            climatology = update_climatology(
+                aggregated=monthly,
+                frequency="monthly",
+                cache_dir=dst_dir / "climatology",
+                variable=variable,
+            )
+            monthly = add_anomalies(
+                aggregated=monthly, climatology=climatology, frequency="monthly"
+            )
+
+            current_run.log_info(f"Computed anomalies for {variable} data")
+
         daily.write_parquet(dst_dir / f"{variable}_daily.parquet")
         current_run.add_file_output(
             Path(dst_dir, f"{variable}_daily.parquet").as_posix()
@@ -194,23 +293,653 @@ def read_boundaries(
     return gpd.read_file(BytesIO(ds_file.read()))
 
 
+def parse_percentile(statistic: str) -> float | None:
+    """Get the percentile corresponding to a statistic name (ex: "p90" or "median").
+
+    Return
+    ------
+    float | None
+        Percentile between 0 and 100, or None if the statistic is not a percentile
+    """
+    if statistic == "median":
+        return 50.0
+    if statistic.startswith("p") and statistic[1:].isdigit():
+        return float(statistic[1:])
+    return None
+
+
+def has_missing_data(da: xr.DataArray) -> bool:
+    """A day is considered to have missing data if not all hours have measurements."""
+    if "step" in da.dims:
+        spatial_dims = [dim for dim in da.dims if dim != "step"]
+        return bool(da.isnull().all(dim=spatial_dims).any())
+    return bool(da.isnull().all())
+
+
+def iter_daily_fields(ds: xr.Dataset, var: str):
+    """Iterate over daily mean, min and max fields of a variable.
+
+    Hourly measurements are reduced to daily fields one day at a time to avoid
+    loading the whole time series in memory. As in the toolbox, days with
+    missing hourly measurements are skipped.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Input dataset with time, step, latitude and longitude dimensions
+    var : str
+        Variable shortname (ex: "t2m", "tp")
+
+    Yields
+    ------
+    tuple[np.datetime64, np.ndarray, np.ndarray, np.ndarray]
+        Day, and daily mean, min and max 2D fields
+    """
+    for day in ds.time.values:
+        da = ds[var].sel(time=day)
+
+        if has_missing_data(da):
+            continue
+
+        # if there is a step dimension (= hourly measurements), aggregate to daily
+        # if not, data is already daily
+        if "step" in da.dims:
+            yield (
+                day,
+                da.mean(dim="step").values,
+                da.min(dim="step").values,
+                da.max(dim="step").values,
+            )
+        else:
+            yield day, da.values, da.values, da.values
+
+
+def zonal_statistics(
+    masks: np.ndarray,
+    mean_field: np.ndarray,
+    min_field: np.ndarray,
+    max_field: np.ndarray,
+    statistics: list[str],
+) -> dict[str, np.ndarray]:
+    """Compute zonal statistics for all boundaries from daily fields.
+
+    Boundaries are processed in chunks so that the dense (boundaries x cells)
+    matrix used for the computation never exceeds `MAX_CHUNK_BYTES`.
+
+    Parameters
+    ----------
+    masks : np.ndarray
+        Binary masks of shape (n_boundaries, n_cells) restricted to the cells
+        covered by at least one boundary
+    mean_field : np.ndarray
+        Daily mean values of the covered cells
+    min_field : np.ndarray
+        Daily min values of the covered cells
+    max_field : np.ndarray
+        Daily max values of the covered cells
+    statistics : list[str]
+        Additional statistics to compute (see `STATISTICS`)
+
+    Return
+    ------
+    dict[str, np.ndarray]
+        Arrays of shape (n_boundaries,) for mean, min, max and each requested statistic
+    """
+    n_boundaries, n_cells = masks.shape
+    chunk_size = max(1, MAX_CHUNK_BYTES // max(1, n_cells * 8))
+
+    percentiles = {
+        stat: parse_percentile(stat)
+        for stat in statistics
+        if parse_percentile(stat) is not None
+    }
+
+    results = {
+        stat: np.full(n_boundaries, np.nan)
+        for stat in ["mean", "min", "max", *statistics]
+    }
+
+    # all-nan slices (ex: boundaries outside of land areas) are expected
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        for start in range(0, n_boundaries, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            m = masks[chunk]
+
+            values = np.where(m, mean_field, np.nan)
+            results["mean"][chunk] = np.nanmean(values, axis=1)
+            if "std" in statistics:
+                results["std"][chunk] = np.nanstd(values, axis=1)
+            if "count" in statistics:
+                results["count"][chunk] = np.count_nonzero(~np.isnan(values), axis=1)
+            if percentiles:
+                q = np.nanpercentile(values, list(percentiles.values()), axis=1)
+                for i, stat in enumerate(percentiles):
+                    results[stat][chunk] = q[i]
+
+            results["min"][chunk] = np.nanmin(np.where(m, min_field, np.nan), axis=1)
+            results["max"][chunk] = np.nanmax(np.where(m, max_field, np.nan), axis=1)
+
+    return results
+
+
+def aggregate(
+    ds: xr.Dataset,
+    var: str,
+    masks: np.ndarray,
+    boundaries_id: list[str],
+    statistics: list[str] | None = None,
+) -> pl.DataFrame:
+    """Aggregate hourly measurements in space and time.
+
+    All statistics are computed in a single pass over each daily time slice,
+    using the same boundary masks.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Input dataset with time, latitude and longitude dimensions
+    var : str
+        Variable shortname (ex: "t2m", "tp")
+    masks : np.ndarray
+        Binary masks of shape (n_boundaries, height, width)
+    boundaries_id : list[str]
+        Unique identifiers of the boundaries, in the same order as the masks
+    statistics : list[str] | None, optional
+        Additional statistics to compute (see `STATISTICS`)
+
+    Return
+    ------
+    pl.DataFrame
+        Daily statistics per boundary with boundary_id, date, mean, min, max,
+        additional statistics, week, month and epi_week columns
+    """
+    statistics = statistics or []
+    boundaries_id = list(boundaries_id)
+
+    # only keep cells covered by at least one boundary
+    masks = masks.reshape(len(masks), -1)
+    covered = masks.any(axis=0)
+    masks = masks[:, covered]
+
+    columns = ["mean", "min", "max", *statistics]
+    schema = {
+        "boundary_id": pl.String,
+        "date": pl.Date,
+        **{col: pl.Float64 for col in columns},
+    }
+
+    frames = []
+    for day, mean_field, min_field, max_field in iter_daily_fields(ds, var):
+        stats = zonal_statistics(
+            masks=masks,
+            mean_field=mean_field.ravel()[covered],
+            min_field=min_field.ravel()[covered],
+            max_field=max_field.ravel()[covered],
+            statistics=statistics,
+        )
+        frames.append(
+            pl.DataFrame(
+                {
+                    "boundary_id": boundaries_id,
+                    "date": [day.astype("datetime64[D]").item()] * len(boundaries_id),
+                    **{col: stats[col] for col in columns},
+                },
+                schema=schema,
+            )
+        )
+
+    # all days can be skipped if data is missing
+    df = pl.concat(frames) if frames else pl.DataFrame(schema=schema)
+
+    # add week, month, and epi_week period columns, formatted as in the toolbox
+    # (ex: "2024W1" and "202401"). Epi. weeks start on sunday and belong to the
+    # year of their wednesday.
+    date = pl.col("date")
+    wednesday = date - pl.duration(days=date.dt.weekday() % 7) + pl.duration(days=3)
+    df = df.with_columns(
+        pl.format("{}W{}", date.dt.iso_year(), date.dt.week()).alias("week"),
+        date.dt.strftime("%Y%m").alias("month"),
+        pl.format(
+            "{}W{}", wednesday.dt.year(), (wednesday.dt.ordinal_day() - 1) // 7 + 1
+        ).alias("epi_week"),
+    )
+
+    return df
+
+
+def carry_statistics(
+    daily: pl.DataFrame,
+    aggregated: pl.DataFrame,
+    statistics: list[str],
+    period_column: str,
+) -> pl.DataFrame:
+    """Carry additional daily statistics through a temporal aggregation.
+
+    Additional statistics are averaged over each period. This also applies to
+    accumulated variables such as total precipitation: sums of daily standard
+    deviations or percentiles are not statistics of the period total, so they
+    are reported as daily averages (ex: mean daily median in mm per day).
+
+    Parameters
+    ----------
+    daily : pl.DataFrame
+        Daily statistics per boundary
+    aggregated : pl.DataFrame
+        Output of `aggregate_per_week` or `aggregate_per_month`
+    statistics : list[str]
+        Additional statistics to carry
+    period_column : str
+        Period column of the daily dataframe ("week", "epi_week" or "month")
+
+    Return
+    ------
+    pl.DataFrame
+        Aggregated dataframe with one additional column per statistic
+    """
+    if not statistics:
+        return aggregated
+
+    # aggregate_per_week() names the period column "week" for epi. weeks too
+    key = "month" if period_column == "month" else "week"
+
+    df = daily.group_by(["boundary_id", pl.col(period_column).alias(key)]).agg(
+        [pl.col(stat).mean() for stat in statistics]
+    )
+
+    return aggregated.join(df, on=["boundary_id", key], how="left")
+
+
+def period_of_year(frequency: str) -> pl.Expr:
+    """Get the week or month of year from the period column of an aggregated dataframe.
+
+    Periods are formatted as "2024W1" for (epi.) weeks and "202401" for months.
+    """
+    period = pl.col(PERIOD_COLUMNS[frequency])
+    if frequency == "monthly":
+        return period.str.slice(4, 2).cast(pl.Int32).alias("period_of_year")
+    return period.str.split("W").list.last().cast(pl.Int32).alias("period_of_year")
+
+
+def update_climatology(
+    aggregated: pl.DataFrame, frequency: str, cache_dir: Path, variable: str
+) -> pl.DataFrame:
+    """Incrementally update the cached climatology of a variable.
+
+    The climatology is stored as running sums (count, sum, sum of squares) per
+    boundary and week or month of year. Values already included in the
+    climatology are cached alongside it (baseline) so that only new or revised
+    periods are added to the running sums: the multi-year baseline is never
+    recomputed from scratch.
+
+    Both files share a generation identifier. If they do not match (ex: the run
+    failed between the two writes), the climatology is rebuilt from the baseline.
+
+    Parameters
+    ----------
+    aggregated : pl.DataFrame
+        Weekly, epi. weekly or monthly aggregated data
+    frequency : str
+        Temporal aggregation frequency ("weekly", "epi_weekly" or "monthly")
+    cache_dir : Path
+        Directory where the climatology and its baseline values are cached
+    variable : str
+        Variable name (ex: "2m_temperature")
+
+    Return
+    ------
+    pl.DataFrame
+        Climatology with boundary_id, period_of_year, count, mean and std columns
+    """
+    keys = ["boundary_id", "period"]
+    sums = ["count", "sum", "sum_sq"]
+    baseline_fp = cache_dir / f"{variable}_{frequency}_baseline.parquet"
+    climatology_fp = cache_dir / f"{variable}_{frequency}_climatology.parquet"
+
+    new = aggregated.select(
+        pl.col("boundary_id"),
+        pl.col(PERIOD_COLUMNS[frequency]).alias("period"),
+        period_of_year(frequency),
+        pl.col("mean").alias("value"),
+    ).filter(pl.col("value").is_not_null() & pl.col("value").is_not_nan())
+
+    climatology = pl.DataFrame(
+        schema={
+            "boundary_id": pl.String,
+            "period_of_year": pl.Int32,
+            **{col: pl.Float64 for col in sums},
+        }
+    )
+
+    if baseline_fp.exists():
+        baseline = pl.read_parquet(baseline_fp)
+        generation = baseline["generation"].unique().to_list()
+        baseline = baseline.drop("generation")
+
+        if climatology_fp.exists():
+            cached = pl.read_parquet(climatology_fp)
+            if cached["generation"].unique().to_list() == generation:
+                climatology = cached.select(climatology.columns)
+
+        if climatology.is_empty() and not baseline.is_empty():
+            current_run.log_warning(
+                f"Cached {frequency} climatology of {variable} is not consistent "
+                "with its baseline, rebuilding it from the baseline"
+            )
+            climatology = baseline.group_by(["boundary_id", "period_of_year"]).agg(
+                pl.len().cast(pl.Float64).alias("count"),
+                pl.col("value").sum().alias("sum"),
+                (pl.col("value") ** 2).sum().alias("sum_sq"),
+            )
+    else:
+        baseline = new.clear()
+
+    # added periods are counted once, revised periods only update sums
+    changes = new.join(
+        baseline.drop("period_of_year"), on=keys, how="left", suffix="_old"
+    ).filter(pl.col("value_old").is_null() | (pl.col("value") != pl.col("value_old")))
+    delta = changes.select(
+        pl.col("boundary_id"),
+        pl.col("period_of_year"),
+        pl.col("value_old").is_null().cast(pl.Float64).alias("count"),
+        (pl.col("value") - pl.col("value_old").fill_null(0)).alias("sum"),
+        (pl.col("value") ** 2 - pl.col("value_old").fill_null(0) ** 2).alias("sum_sq"),
+    )
+
+    climatology = (
+        pl.concat([climatology, delta.cast(climatology.schema)])
+        .group_by(["boundary_id", "period_of_year"])
+        .agg([pl.col(col).sum() for col in sums])
+        .sort(["boundary_id", "period_of_year"])
+        .with_columns(
+            (pl.col("sum") / pl.col("count")).alias("mean"),
+            (
+                (pl.col("sum_sq") - pl.col("sum") ** 2 / pl.col("count"))
+                / (pl.col("count") - 1)
+            )
+            .clip(lower_bound=0)
+            .sqrt()
+            .alias("std"),
+        )
+    )
+
+    baseline = pl.concat(
+        [
+            baseline.join(changes, on=keys, how="anti"),
+            changes.select(baseline.columns),
+        ]
+    )
+
+    generation = uuid.uuid4().hex
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(
+        baseline.with_columns(pl.lit(generation).alias("generation")), baseline_fp
+    )
+    write_atomic(
+        climatology.with_columns(pl.lit(generation).alias("generation")), climatology_fp
+    )
+
+    current_run.log_info(
+        f"Updated {frequency} climatology of {variable} with {len(changes)} new or revised values"
+    )
+
+    return climatology.select("boundary_id", "period_of_year", "count", "mean", "std")
+
+
+def write_atomic(df: pl.DataFrame, fp: Path) -> None:
+    """Write a dataframe to a parquet file, replacing any existing file atomically.
+
+    The temporary file name is unique, so that concurrent runs writing to the same
+    file (ex: ERA5 Aggregate and ERA5 Sync) do not overwrite each other's writes.
+    """
+    tmp = fp.with_name(f".{fp.name}.{uuid.uuid4().hex}.tmp")
+    df.write_parquet(tmp)
+    tmp.replace(fp)
+
+
+def add_anomalies(
+    aggregated: pl.DataFrame, climatology: pl.DataFrame, frequency: str
+) -> pl.DataFrame:
+    """Add anomaly and z-score columns to aggregated data.
+
+    Anomalies are computed as the difference between the mean value and the
+    climatological mean for the same boundary and week or month of year.
+    Z-scores are not defined for climatologies based on less than 2 values.
+    """
+    climatology = climatology.select(
+        pl.col("boundary_id"),
+        pl.col("period_of_year"),
+        pl.col("mean").alias("clim_mean"),
+        pl.when(pl.col("count") > 1).then(pl.col("std")).alias("clim_std"),
+    )
+
+    return (
+        aggregated.with_columns(period_of_year(frequency))
+        .join(climatology, on=["boundary_id", "period_of_year"], how="left")
+        .with_columns((pl.col("mean") - pl.col("clim_mean")).alias("anomaly"))
+        .with_columns(
+            pl.when(pl.col("clim_std") > 0)
+            .then(pl.col("anomaly") / pl.col("clim_std"))
+            .alias("zscore")
+        )
+        .drop("period_of_year", "clim_mean", "clim_std")
+    )
+
+
+def read_grib(file: Path) -> bytes:
+    """Read the content of a raw grib file.
+
+    Files downloaded from the CDS can be zip archives containing a data.grib file,
+    in which case the content of the data.grib file is returned.
+    """
+    if zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file.as_posix(), "r") as zip:
+            return zip.read("data.grib")
+    return file.read_bytes()
+
+
+def scan_grib(file: Path) -> pl.DataFrame:
+    """Index the messages of a grib file.
+
+    Only message headers are decoded, data values are not read.
+
+    Parameters
+    ----------
+    file : Path
+        Path to the grib (or zipped grib) file
+
+    Return
+    ------
+    pl.DataFrame
+        One row per message with file, size, mtime, offset, length, short_name,
+        grid (md5 of the grid section), valid_time and expver columns
+    """
+    # eccodes must be loaded after geopandas, as cfgrib does, or the process may
+    # crash when the two libraries are loaded in the opposite order
+    import eccodes
+
+    stat = file.stat()
+    rows = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = file
+        if zipfile.is_zipfile(file):
+            src = Path(tmpdir, file.name)
+            src.write_bytes(read_grib(file))
+
+        with open(src, "rb") as f:
+            while (gid := eccodes.codes_grib_new_from_file(f)) is not None:
+                try:
+                    date = eccodes.codes_get(gid, "validityDate")
+                    time = eccodes.codes_get(gid, "validityTime")
+                    rows.append(
+                        {
+                            "file": file.name,
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime_ns,
+                            "offset": eccodes.codes_get(gid, "offset"),
+                            "length": eccodes.codes_get(gid, "totalLength"),
+                            "short_name": eccodes.codes_get(gid, "shortName"),
+                            "grid": eccodes.codes_get(gid, "md5GridSection"),
+                            "valid_time": datetime.strptime(
+                                f"{date:08d}{time:04d}", "%Y%m%d%H%M"
+                            ),
+                            "expver": (
+                                eccodes.codes_get(gid, "expver", ktype=str)
+                                if eccodes.codes_is_defined(gid, "expver")
+                                else None
+                            ),
+                        }
+                    )
+                finally:
+                    eccodes.codes_release(gid)
+
+    return pl.DataFrame(rows, schema=GRIB_INDEX_SCHEMA)
+
+
+def update_grib_index(input_dir: Path, pattern: str = "*.grib") -> pl.DataFrame:
+    """Update the persisted index of grib messages available in the input directory.
+
+    Only new or modified files (based on their size and modification time) are
+    scanned, entries of deleted files are removed.
+
+    Parameters
+    ----------
+    input_dir : Path
+        Directory containing raw grib files
+    pattern : str, optional
+        Glob pattern of the files to index (default: "*.grib")
+
+    Return
+    ------
+    pl.DataFrame
+        Index of the messages of the files matching the pattern
+    """
+    index_fp = input_dir / GRIB_INDEX
+    index = pl.DataFrame(schema=GRIB_INDEX_SCHEMA)
+    rebuild = True
+    if index_fp.exists():
+        try:
+            cached = pl.read_parquet(index_fp)
+        except pl.exceptions.ComputeError:
+            current_run.log_warning(
+                f"Discarded unreadable GRIB index {index_fp.as_posix()}"
+            )
+            cached = None
+
+        # unreadable indexes, or indexes written with a different schema, are
+        # discarded and rebuilt
+        if cached is not None and cached.schema == index.schema:
+            index = cached
+            rebuild = False
+
+    files = sorted(input_dir.glob(pattern))
+    known = set(index.select("file", "size", "mtime").unique().iter_rows())
+
+    to_scan = []
+    for file in files:
+        stat = file.stat()
+        if (file.name, stat.st_size, stat.st_mtime_ns) not in known:
+            to_scan.append(file)
+
+    existing = [f.name for f in input_dir.glob("*.grib")]
+    outdated = index.filter(pl.col("file").is_in(existing).not_()).height
+
+    if to_scan or outdated or rebuild:
+        index = pl.concat(
+            [
+                index.filter(
+                    pl.col("file").is_in(existing)
+                    & pl.col("file").is_in([f.name for f in to_scan]).not_()
+                ),
+                *[scan_grib(file) for file in to_scan],
+            ]
+        )
+        write_atomic(index, index_fp)
+
+    if to_scan:
+        current_run.log_info(f"Indexed {len(to_scan)} new or modified GRIB files")
+
+    return index.filter(pl.col("file").is_in([f.name for f in files]))
+
+
+def select_grib_messages(index: pl.DataFrame) -> pl.DataFrame:
+    """Select a single grib message per parameter, grid and valid time.
+
+    When several files contain data for the same valid time (ex: preliminary
+    ERA5T data followed by the final ERA5 revision), final data (expver 0001)
+    is preferred over preliminary data, then the most recently modified file.
+
+    Messages on a different grid than the most recently modified file (ex: after
+    a change of the area of interest) are ignored, as they cannot be merged
+    into a single dataset.
+    """
+    if index.is_empty():
+        return index
+
+    latest_grid = index.sort("mtime", "file", descending=True)["grid"][0]
+    other_grids = index.filter(pl.col("grid") != latest_grid)
+    if not other_grids.is_empty():
+        current_run.log_warning(
+            f"Ignored {len(other_grids)} GRIB messages from "
+            f"{other_grids['file'].n_unique()} files on a different grid"
+        )
+
+    return (
+        index.filter(pl.col("grid") == latest_grid)
+        .with_columns((pl.col("expver").fill_null("0001") == "0001").alias("final"))
+        .sort(
+            ["valid_time", "final", "mtime", "file"],
+            descending=[False, True, True, True],
+        )
+        .unique(
+            subset=["short_name", "grid", "valid_time"],
+            keep="first",
+            maintain_order=True,
+        )
+        .drop("final")
+    )
+
+
+def write_grib_messages(
+    messages: pl.DataFrame, input_dir: Path, dst_file: Path
+) -> None:
+    """Concatenate selected grib messages into a single grib file."""
+    with open(dst_file, "wb") as dst:
+        for (file,), df in messages.sort("file", "offset").group_by(
+            "file", maintain_order=True
+        ):
+            data = read_grib(Path(input_dir, file))
+            dst.writelines(
+                data[offset : offset + length]
+                for offset, length in df.select("offset", "length").iter_rows()
+            )
+
+
 def get_daily(
-    input_dir: Path, boundaries: gpd.GeoDataFrame, variable: str, column_uid: str
+    input_dir: Path,
+    boundaries: gpd.GeoDataFrame,
+    variable: str,
+    column_uid: str,
+    statistics: list[str] | None = None,
+    pattern: str = "*.grib",
 ) -> pl.DataFrame:
-    # build xarray dataset by merging all available grib files across the time dimension
+    statistics = statistics or []
+
+    # build xarray dataset from a single grib file containing the selected messages of
+    # all available grib files, to avoid concatenating overlapping datasets
     with tempfile.TemporaryDirectory() as tmpdir:
-        for file in input_dir.glob("*.grib"):
-            # if the .grib file is actually a zip file, extract the data.grib file
-            # and copy its content instead with same filename
-            if zipfile.is_zipfile(file):
-                with zipfile.ZipFile(file.as_posix(), "r") as zip:
-                    bytes = zip.read("data.grib")
-                with open(Path(tmpdir, file.name), "wb") as f:
-                    f.write(bytes)
-
-            # if it's not a zip file, copy the grib file directly
-            else:
-                copyfile(src=file.as_posix(), dst=Path(tmpdir, file.name).as_posix())
+        index = update_grib_index(input_dir=input_dir, pattern=pattern)
+        messages = select_grib_messages(index)
+        write_grib_messages(
+            messages=messages, input_dir=input_dir, dst_file=Path(tmpdir, "data.grib")
+        )
+
+        current_run.log_info(
+            f"Selected {len(messages)} out of {len(index)} GRIB messages "
+            f"from {index['file'].n_unique()} files"
+        )
 
         ds = merge(Path(tmpdir))
         ncols = len(ds.longitude)
@@ -223,27 +952,25 @@ def get_daily(
         var = VARIABLES[variable]["shortname"]
 
         daily = aggregate(
-            ds=ds, var=var, masks=masks, boundaries_id=boundaries[column_uid]
+            ds=ds,
+            var=var,
+            masks=masks,
+            boundaries_id=boundaries[column_uid],
+            statistics=statistics,
         )
 
+    # cell counts and dispersion statistics are not affected by unit offsets
+    values = ["mean", "min", "max"] + [
+        stat for stat in statistics if parse_percentile(stat) is not None
+    ]
+
     # kelvin to celsius
     if variable == "2m_temperature":
-        daily = daily.with_columns(
-            [
-                pl.col("mean") - 273.15,
-                pl.col("min") - 273.15,
-                pl.col("max") - 273.15,
-            ]
-        )
+        daily = daily.with_columns([pl.col(col) - 273.15 for col in values])
 
     # m to mm
     if variable == "total_precipitation":
-        daily = daily.with_columns(
-            [
-                pl.col("mean") * 1000,
-                pl.col("min") * 1000,
-                pl.col("max") * 1000,
-            ]
-        )
+        values += [stat for stat in statistics if stat == "std"]
+        daily = daily.with_columns([pl.col(col) * 1000 for col in values])
 
     return daily
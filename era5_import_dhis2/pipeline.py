@@ -12,6 +12,18 @@ from openhexa.sdk import (
 )
 from openhexa.toolbox.dhis2 import DHIS2
 
+# index of archived payloads, written in the output directory of each variable
+ARCHIVE_INDEX = "index.parquet"
+
+PAYLOAD_SCHEMA = {
+    "dataElement": pl.String,
+    "categoryOptionCombo": pl.String,
+    "attributeOptionCombo": pl.String,
+    "orgUnit": pl.String,
+    "period": pl.String,
+    "value": pl.String,
+}
+
 
 @pipeline("__pipeline_id__", name="ERA5 Import DHIS2")
 @parameter(
@@ -93,6 +105,16 @@ from openhexa.toolbox.dhis2 import DHIS2
 @parameter(
     "dry_run", type=bool, default=False, name="Dry run", help="Simulate DHIS2 import"
 )
+@parameter(
+    "replay_run",
+    type=str,
+    name="Replay run",
+    help=(
+        "Push again the archived payloads of a previous run "
+        "(ex: 2024-01-01_12-00-00, or 2024-01-01_12-00-00_2024W1-2024W4 for ERA5 Sync)"
+    ),
+    required=False,
+)
 def era5_import_dhis2(
     input_dir: str,
     output_dir: str,
@@ -105,6 +127,7 @@ def era5_import_dhis2(
     dhis2_dx_humidity: str | None = None,
     import_mode: str = "Append",
     dry_run: bool = False,
+    replay_run: str | None = None,
 ):
     """Import ERA5 aggregate statistics into a DHIS2 dataset."""
     input_dir = Path(workspace.files_path, input_dir)
@@ -121,6 +144,33 @@ def era5_import_dhis2(
         "volumetric_soil_water_layer_1",
     )
 
+    # replay archived payloads without reading and converting aggregates again
+    if replay_run:
+        replay_variables = [
+            variable
+            for variable in variables
+            if Path(output_dir, variable, replay_run).exists()
+        ]
+        if not replay_variables:
+            msg = f"Run {replay_run} not found in {output_dir.as_posix()}"
+            current_run.log_error(msg)
+            raise FileNotFoundError(msg)
+
+        for variable in variables:
+            if variable not in replay_variables:
+                msg = f"Skipping replay of variable {variable}: run {replay_run} not found"
+                current_run.log_warning(msg)
+                continue
+
+            payload = read_archive(
+                output_dir=Path(output_dir, variable), run=replay_run
+            )
+            summary = push_data_values(dhis2=dhis2, payload=payload, dry_run=dry_run)
+            write_replay_report(
+                output_dir=Path(output_dir, variable), run=replay_run, summary=summary
+            )
+        return
+
     for dx_uid, variable in zip(dx_uids, variables):
         if dx_uid is None:
             msg = f"Skipping import of variable {variable}: no DHIS2 data element provided"
@@ -135,11 +185,8 @@ def era5_import_dhis2(
         )
 
         if import_mode != "Overwrite":
-            existing_data = get_existing_data(
-                dhis2=dhis2, dataset_uid=dhis2_dataset, stats=stats
-            )
             stats = filter_periods(
-                stats=stats, existing_data=existing_data, dx_uid=dx_uid
+                dhis2=dhis2, dataset_uid=dhis2_dataset, stats=stats, dx_uid=dx_uid
             )
 
         payload = to_json(stats=stats, dx_uid=dx_uid, coc_uid=dhis2_coc)
@@ -178,15 +225,49 @@ def read_aggregate(input_dir: Path, variable: str, frequency: str) -> pl.DataFra
 
 
 @era5_import_dhis2.task
-def get_existing_data(
-    dhis2: DHIS2, dataset_uid: str, stats: pl.DataFrame
+def filter_periods(
+    dhis2: DHIS2, dataset_uid: str, stats: pl.DataFrame, dx_uid: str
 ) -> pl.DataFrame:
-    """Fetch existing data for a single org unit.
+    """Filter out periods for which data already exists."""
+    existing_periods = get_existing_periods(
+        dhis2=dhis2,
+        dataset_uid=dataset_uid,
+        org_unit_uid=stats["orgUnit"].unique().to_list()[0],
+        dx_uid=dx_uid,
+    )
+    return stats.filter(pl.col("period").is_in(existing_periods).not_())
+
+
+@era5_import_dhis2.task
+def to_json(stats: pl.DataFrame, dx_uid: str, coc_uid: str) -> list[dict]:
+    """Convert aggregate dataframe to JSON-like data values."""
+    return format_data_values(stats=stats, dx_uid=dx_uid, coc_uid=coc_uid)
+
+
+@era5_import_dhis2.task
+def push_data_values(dhis2: DHIS2, payload: list[dict], dry_run: bool) -> dict:
+    """Push data values to DHIS2."""
+    return post_data_values(dhis2=dhis2, payload=payload, dry_run=dry_run)
+
+
+@era5_import_dhis2.task
+def write_report(output_dir: Path, payload: list[dict], summary: dict) -> None:
+    """Write DHIS2 import report and archive payload to output directory."""
+    run = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
+    archive_payload(output_dir=output_dir, run=run, payload=payload, summary=summary)
+
+
+# The functions below are not tasks so that they can be reused by the ERA5 Sync
+# pipeline (era5_sync/import_dhis2.py is a symlink to this file).
+
+
+def get_existing_periods(
+    dhis2: DHIS2, dataset_uid: str, org_unit_uid: str, dx_uid: str
+) -> list[str]:
+    """Fetch periods for which data already exists for a single org unit.
 
     Used to filter out periods for which data already exists before importing new data.
     """
-    org_unit_uid = stats["orgUnit"].unique().to_list()[0]
-
     data_values = dhis2.data_value_sets.get(
         datasets=[dataset_uid],
         org_units=[org_unit_uid],
@@ -194,34 +275,23 @@ def get_existing_data(
         end_date=datetime.now(tz=timezone.utc).strftime("%Y-%m-%d"),
     )
 
-    return pl.DataFrame(data_values)
-
-
-@era5_import_dhis2.task
-def filter_periods(
-    stats: pl.DataFrame, existing_data: pl.DataFrame, dx_uid: str
-) -> pl.DataFrame:
-    """Filter out periods for which data already exists."""
+    existing_data = pl.DataFrame(data_values)
     if existing_data.is_empty():
         msg = f"Did not found any existing data values for data element {dx_uid}"
         current_run.log_info(msg)
-        return stats
+        return []
 
     existing_data = existing_data.filter(pl.col("dataElement") == dx_uid)
     existing_periods = existing_data["period"].unique().to_list()
 
-    msg = (
-        f"Found {len(existing_periods)} existing periods for data element {dx_uid}. "
-        "Filtering payload..."
-    )
+    msg = f"Found {len(existing_periods)} existing periods for data element {dx_uid}"
     current_run.log_info(msg)
 
-    return stats.filter(pl.col("period").is_in(existing_periods).not_())
+    return existing_periods
 
 
-@era5_import_dhis2.task
-def to_json(stats: pl.DataFrame, dx_uid: str, coc_uid: str) -> list[dict]:
-    """Convert aggregate dataframe to JSON-like data values."""
+def format_data_values(stats: pl.DataFrame, dx_uid: str, coc_uid: str) -> list[dict]:
+    """Convert aggregate dataframe (orgUnit, period, value) to DHIS2 data values."""
     stats = stats.select(
         pl.lit(dx_uid).alias("dataElement"),
         pl.lit(coc_uid).alias("categoryOptionCombo"),
@@ -233,9 +303,10 @@ def to_json(stats: pl.DataFrame, dx_uid: str, coc_uid: str) -> list[dict]:
     return stats.to_dicts()
 
 
-@era5_import_dhis2.task
-def push_data_values(dhis2: DHIS2, payload: list[dict], dry_run: bool) -> dict:
-    """Push data values to DHIS2."""
+def post_data_values(
+    dhis2: DHIS2, payload: list[dict], dry_run: bool, period_range: str | None = None
+) -> dict:
+    """Post data values to DHIS2, logging the imported period range if provided."""
     dhis2.data_value_sets.MAX_POST_DATA_VALUES = 1000
     summary = dhis2.data_value_sets.post(
         data_values=payload,
@@ -245,30 +316,130 @@ def push_data_values(dhis2: DHIS2, payload: list[dict], dry_run: bool) -> dict:
     )
 
     msg = f"Imported {len(payload)} data values to DHIS2"
+    if period_range:
+        msg += f" ({period_range})"
     current_run.log_info(msg)
 
     return summary
 
 
-@era5_import_dhis2.task
-def write_report(output_dir: Path, payload: list[dict], summary: dict) -> None:
-    """Write DHIS2 import report to output directory."""
-    output_dir = Path(
-        output_dir, datetime.now(tz=timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
+def archive_payload(
+    output_dir: Path, run: str, payload: list[dict], summary: dict
+) -> None:
+    """Archive payload and DHIS2 import report of a run.
+
+    The payload is archived as a zstd-compressed parquet file in the run directory,
+    and referenced in the archive index of the output directory along with its
+    data element and period range.
+    """
+    run_dir = Path(output_dir, run)
+    run_dir.mkdir(parents=True, exist_ok=True)
+
+    payload = pl.DataFrame(payload, schema=PAYLOAD_SCHEMA)
+    payload.write_parquet(run_dir / "payload.parquet", compression="zstd")
+
+    with open(run_dir / "report.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    update_archive_index(output_dir=output_dir, run=run, payload=payload)
+
+    msg = f"Import report written to {run_dir.as_posix()}"
+    current_run.log_info(msg)
+
+    current_run.add_file_output((run_dir / "payload.parquet").as_posix())
+    current_run.add_file_output((run_dir / "report.json").as_posix())
+
+
+def update_archive_index(output_dir: Path, run: str, payload: pl.DataFrame) -> None:
+    """Add archived payload to the archive index of the output directory.
+
+    The index has one row per run and data element, with the range of periods
+    covered by the payload.
+    """
+    index_fp = Path(output_dir, ARCHIVE_INDEX)
+
+    entries = (
+        payload.with_columns(period_sort_key().alias("key"))
+        .sort("key")
+        .group_by("dataElement", maintain_order=True)
+        .agg(
+            pl.col("period").first().alias("period_start"),
+            pl.col("period").last().alias("period_end"),
+            pl.len().alias("data_values"),
+        )
+        .select(
+            pl.lit(run).alias("run"),
+            pl.col("dataElement"),
+            pl.col("period_start"),
+            pl.col("period_end"),
+            pl.col("data_values").cast(pl.Int64),
+            pl.lit(f"{run}/payload.parquet").alias("path"),
+        )
     )
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(output_dir / "payload.json", "w") as f:
-        json.dump(payload, f, indent=2)
+    if index_fp.exists():
+        entries = pl.concat(
+            [pl.read_parquet(index_fp).filter(pl.col("run") != run), entries]
+        )
+
+    entries.write_parquet(index_fp)
+
+
+def period_sort_key() -> pl.Expr:
+    """Sortable representation of DHIS2 periods (ex: "2024W9" becomes "2024W09")."""
+    return pl.col("period").str.replace(r"W(\d)$", "W0${1}")
+
+
+@era5_import_dhis2.task
+def read_archive(output_dir: Path, run: str) -> list[dict]:
+    """Read archived DHIS2 payload of a previous run.
+
+    Payloads archived as JSON before the parquet archive was introduced are also
+    supported.
+    """
+    index_fp = Path(output_dir, ARCHIVE_INDEX)
+
+    paths = []
+    if index_fp.exists():
+        index = pl.read_parquet(index_fp).filter(pl.col("run") == run)
+        paths = index["path"].unique(maintain_order=True).to_list()
+
+    if paths:
+        payload = pl.concat(
+            [pl.read_parquet(Path(output_dir, path)) for path in paths]
+        ).to_dicts()
+    elif Path(output_dir, run, "payload.parquet").exists():
+        payload = pl.read_parquet(Path(output_dir, run, "payload.parquet")).to_dicts()
+    elif Path(output_dir, run, "payload.json").exists():
+        with open(Path(output_dir, run, "payload.json")) as f:
+            payload = json.load(f)
+    else:
+        msg = f"No archived payload found for run {run} in {output_dir.as_posix()}"
+        current_run.log_error(msg)
+        raise FileNotFoundError(msg)
+
+    msg = f"Loaded {len(payload)} archived data values from run {run}"
+    current_run.log_info(msg)
+
+    return payload
+
+
+@era5_import_dhis2.task
+def write_replay_report(output_dir: Path, run: str, summary: dict) -> None:
+    """Write DHIS2 import report of a replayed run to its archive directory."""
+    fp = Path(
+        output_dir,
+        run,
+        f"report_replay_{datetime.now(tz=timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')}.json",
+    )
 
-    with open(output_dir / "report.json", "w") as f:
+    with open(fp, "w") as f:
         json.dump(summary, f, indent=2)
 
-    msg = f"Import report written to {output_dir.as_posix()}"
+    msg = f"Replay report written to {fp.as_posix()}"
     current_run.log_info(msg)
 
-    current_run.add_file_output((output_dir / "payload.json").as_posix())
-    current_run.add_file_output((output_dir / "report.json").as_posix())
+    current_run.add_file_output(fp.as_posix())
 
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+../era5_aggregate/pipeline.py
\ No newline at end of file
@@ -0,0 +1 @@
+../era5_extract/pipeline.py
\ No newline at end of file
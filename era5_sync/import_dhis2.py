@@ -0,0 +1 @@
+../era5_import_dhis2/pipeline.py
\ No newline at end of file
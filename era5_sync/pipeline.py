@@ -0,0 +1,734 @@
+import asyncio
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+import polars as pl
+from aggregate import get_daily  # symlink to era5_aggregate/pipeline.py
+from extract import get_bounds, read_boundaries  # symlink to era5_extract/pipeline.py
+from import_dhis2 import (  # symlink to era5_import_dhis2/pipeline.py
+    archive_payload,
+    format_data_values,
+    get_existing_periods,
+    period_sort_key,
+    post_data_values,
+)
+from openhexa.sdk import (
+    CustomConnection,
+    Dataset,
+    DHIS2Connection,
+    current_run,
+    parameter,
+    pipeline,
+    workspace,
+)
+from openhexa.toolbox.dhis2 import DHIS2
+from openhexa.toolbox.era5.aggregate import aggregate_per_month, aggregate_per_week
+from openhexa.toolbox.era5.cds import (
+    CDS,
+    VARIABLES,
+    build_request,
+    date_range,
+    iter_chunks,
+    list_datetimes_in_dir,
+)
+
+# max. number of items waiting between two stages
+QUEUE_SIZE = 2
+
+# default hours to download depending on climate variable
+HOURS = {
+    "2m_temperature": [0, 6, 12, 18],
+    "total_precipitation": [23],
+    "volumetric_soil_water_layer_1": [0, 6, 12, 18],
+}
+
+
+@pipeline("__pipeline_id__", name="ERA5 Sync")
+@parameter(
+    "start_date",
+    type=str,
+    name="Start date",
+    help="Start date of extraction period.",
+    default="2018-01-01",
+)
+@parameter(
+    "end_date",
+    type=str,
+    name="End date",
+    help="End date of extraction period. Latest available by default.",
+    required=False,
+)
+@parameter(
+    "cds_connection",
+    name="Climate data store",
+    type=CustomConnection,
+    help="Credentials for connection to the Copernicus Climate Data Store",
+    required=True,
+)
+@parameter(
+    "boundaries_dataset",
+    name="Boundaries dataset",
+    type=Dataset,
+    help="Input dataset containing boundaries geometries",
+    required=True,
+)
+@parameter(
+    "boundaries_file",
+    name="Boundaries filename in dataset",
+    type=str,
+    help="Filename of the boundaries file to use in the boundaries dataset",
+    required=False,
+    default="district.parquet",
+)
+@parameter(
+    "boundaries_column_uid",
+    name="Boundaries column UID",
+    type=str,
+    help="Column name containing unique identifier for boundaries geometries",
+    required=True,
+    default="id",
+)
+@parameter(
+    "variable",
+    name="Variable",
+    type=str,
+    choices=[
+        "2 metre temperature",
+        "Total precipitation",
+        "Volumetric soil water layer 1",
+    ],
+    help="ERA5-Land variable of interest",
+)
+@parameter(
+    "dhis2_connection",
+    type=DHIS2Connection,
+    name="Target DHIS2 instance",
+    help="Target DHIS2 instance",
+    required=True,
+)
+@parameter(
+    "frequency",
+    type=str,
+    name="Frequency",
+    choices=["weekly", "monthly"],
+    help="Temporal aggregation frequency",
+    required=True,
+)
+@parameter(
+    "dhis2_dataset",
+    type=str,
+    name="DHIS2 dataset",
+    help="Target DHIS2 dataset",
+    required=True,
+)
+@parameter(
+    "dhis2_dx",
+    type=str,
+    name="DHIS2 data element",
+    help="DHIS2 data element for the variable of interest",
+    required=True,
+)
+@parameter(
+    "dhis2_coc",
+    type=str,
+    name="DHIS2 category option combo",
+    help="DHIS2 category option combo UID",
+    default="HllvX50cXC0",
+    required=True,
+)
+@parameter(
+    "import_mode",
+    type=str,
+    name="Import mode",
+    help="Import mode",
+    choices=["Append", "Overwrite"],
+    default="Append",
+    required=True,
+)
+@parameter(
+    "dry_run", type=bool, default=False, name="Dry run", help="Simulate DHIS2 import"
+)
+@parameter(
+    "raw_dir",
+    type=str,
+    name="Raw data directory",
+    help="Output directory for the extracted data",
+    default="data/era5/raw",
+)
+@parameter(
+    "aggregate_dir",
+    type=str,
+    name="Aggregate directory",
+    help="Output directory for the aggregated data",
+    default="data/era5/aggregate",
+)
+@parameter(
+    "import_dir",
+    type=str,
+    name="Import directory",
+    help="Output directory for the DHIS2 import reports",
+    default="data/era5/import",
+)
+def era5_sync(
+    start_date: str,
+    cds_connection: CustomConnection,
+    boundaries_dataset: Dataset,
+    boundaries_column_uid: str,
+    variable: str,
+    dhis2_connection: DHIS2Connection,
+    frequency: str,
+    dhis2_dataset: str,
+    dhis2_dx: str,
+    dhis2_coc: str,
+    raw_dir: str,
+    aggregate_dir: str,
+    import_dir: str,
+    end_date: str | None = None,
+    boundaries_file: str | None = None,
+    import_mode: str = "Append",
+    dry_run: bool = False,
+):
+    """Extract, aggregate and import ERA5 data into DHIS2 in a single run.
+
+    Stages are connected with bounded queues: each downloaded month is aggregated
+    as soon as it is available, and each completed period is pushed to DHIS2 as
+    soon as it is aggregated.
+    """
+    cds = CDS(key=cds_connection.key)
+    current_run.log_info("Successfully connected to the Climate Data Store")
+
+    dhis2 = DHIS2(
+        connection=dhis2_connection, cache_dir=Path(workspace.files_path, ".cache")
+    )
+
+    boundaries = read_boundaries(boundaries_dataset, filename=boundaries_file)
+    bounds = get_bounds(boundaries)
+    current_run.log_info(f"Using area of interest: {bounds}")
+
+    if not end_date:
+        end_date = datetime.now().astimezone(timezone.utc).strftime("%Y-%m-%d")
+        current_run.log_info(f"End date set to {end_date}")
+
+    # find variable code from fullname provided in parameters
+    var_code = None
+    for code, meta in VARIABLES.items():
+        if meta["name"] == variable:
+            var_code = code
+            break
+    if var_code is None:
+        msg = f"Variable {variable} not supported"
+        current_run.log_error(msg)
+        raise ValueError(msg)
+
+    existing_periods = []
+    if import_mode != "Overwrite":
+        existing_periods = get_existing_periods(
+            dhis2=dhis2,
+            dataset_uid=dhis2_dataset,
+            org_unit_uid=boundaries[boundaries_column_uid].iloc[0],
+            dx_uid=dhis2_dx,
+        )
+
+    asyncio.run(
+        sync(
+            months=list(iter_months(start=start_date, end=end_date)),
+            extract_kwargs={
+                "client": cds,
+                "variable": var_code,
+                "output_dir": Path(workspace.files_path, raw_dir),
+                "area": bounds,
+                "time": HOURS.get(var_code, [0, 6, 12, 18]),
+            },
+            aggregate_kwargs={
+                "boundaries": boundaries,
+                "variable": var_code,
+                "column_uid": boundaries_column_uid,
+                "frequency": frequency,
+                "input_dir": Path(workspace.files_path, raw_dir, var_code),
+                "output_dir": Path(workspace.files_path, aggregate_dir, var_code),
+            },
+            import_kwargs={
+                "dhis2": dhis2,
+                "dx_uid": dhis2_dx,
+                "coc_uid": dhis2_coc,
+                "existing_periods": existing_periods,
+                "dry_run": dry_run,
+                "output_dir": Path(workspace.files_path, import_dir, var_code),
+            },
+        )
+    )
+
+
+def iter_months(start: str, end: str):
+    """Iterate over the months of a period.
+
+    Parameters
+    ----------
+    start : str
+        Start date of the period (YYYY-MM-DD)
+    end : str
+        End date of the period (YYYY-MM-DD)
+
+    Yields
+    ------
+    tuple[date, date]
+        First and last day of each month, clipped to the period
+    """
+    start = datetime.strptime(start, "%Y-%m-%d").date()
+    end = datetime.strptime(end, "%Y-%m-%d").date()
+
+    month = start.replace(day=1)
+    while month <= end:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        yield max(month, start), min(next_month - timedelta(days=1), end)
+        month = next_month
+
+
+async def sync(
+    months: list[tuple[date, date]],
+    extract_kwargs: dict,
+    aggregate_kwargs: dict,
+    import_kwargs: dict,
+) -> None:
+    """Run the extract, aggregate and import stages concurrently.
+
+    Blocking work is offloaded to threads so that a month can be downloaded
+    while the previous one is aggregated and the periods before are imported.
+    If a stage fails, the other stages are cancelled.
+    """
+    months_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    periods_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(extract_stage(months, months_queue, **extract_kwargs))
+        tg.create_task(aggregate_stage(months_queue, periods_queue, **aggregate_kwargs))
+        tg.create_task(import_stage(periods_queue, **import_kwargs))
+
+
+async def extract_stage(
+    months: list[tuple[date, date]],
+    months_queue: asyncio.Queue,
+    client: CDS,
+    variable: str,
+    output_dir: Path,
+    area: tuple[float],
+    time: list[int] | None = None,
+) -> None:
+    """Download raw data and pass each month to the aggregation stage when available.
+
+    Data requests for all months are submitted at once so that CDS queue waits
+    overlap, then polled until completed. Months are passed to the aggregation
+    stage in chronological order, as soon as all their files are downloaded.
+    """
+    dst_dir = Path(output_dir, variable)
+    dst_dir.mkdir(parents=True, exist_ok=True)
+
+    start = datetime.combine(months[0][0], datetime.min.time(), tzinfo=timezone.utc)
+    end = datetime.combine(months[-1][1], datetime.min.time(), tzinfo=timezone.utc)
+    end = min(end, await asyncio.to_thread(lambda: client.latest))
+
+    # existing files are decompressed and scanned once, before the aggregation
+    # stage starts reading them
+    available = [
+        dtime.date()
+        for dtime in await asyncio.to_thread(list_datetimes_in_dir, dst_dir)
+    ]
+    dates = [d for d in date_range(start, end) if d.date() not in available]
+    current_run.log_info(f"Will request data for {len(dates)} dates")
+
+    pending = {}
+    for remote in await asyncio.to_thread(
+        submit_requests,
+        client=client,
+        variable=variable,
+        dates=dates,
+        area=area,
+        time=time,
+    ):
+        month = (int(remote.request["year"]), int(remote.request["month"]))
+        pending.setdefault(month, []).append(remote)
+
+    months = list(months)
+    while months:
+        start, _ = months[0]
+        remotes = pending.get((start.year, start.month))
+
+        if not remotes:
+            await months_queue.put(months.pop(0))
+            continue
+
+        # download all completed requests, not only those of the next month
+        for remotes_ in pending.values():
+            for remote in list(remotes_):
+                if await asyncio.to_thread(lambda r=remote: r.results_ready):
+                    await asyncio.to_thread(
+                        download_grib, remote=remote, dst_dir=dst_dir
+                    )
+                    remotes_.remove(remote)
+
+        if remotes:
+            n = sum(len(remotes_) for remotes_ in pending.values())
+            current_run.log_info(
+                f"Still {n} files to download. Waiting 30s before retrying..."
+            )
+            await asyncio.sleep(30)
+
+    await months_queue.put(None)
+
+
+def submit_requests(
+    client: CDS,
+    variable: str,
+    dates: list[datetime],
+    area: tuple[float],
+    time: list[int] | None = None,
+) -> list:
+    """Submit CDS data requests (max. one per month) needed to cover the dates.
+
+    Identical requests submitted recently are reused instead of submitting new ones.
+    """
+    if not dates:
+        return []
+
+    existing_requests = client.get_remote_requests()
+    remotes = []
+
+    for chunk in iter_chunks(dates):
+        request = build_request(
+            variable=variable, data_format="grib", area=area, time=time, **chunk
+        )
+        remote = client.get_remote_from_request(request, existing_requests)
+        if remote is None:
+            remote = client.submit(request)
+            msg = f"Submitted new data request for {request.year}-{request.month}"
+        else:
+            msg = f"Found existing request for {request.year}-{request.month}"
+        current_run.log_info(msg)
+        remotes.append(remote)
+
+    return remotes
+
+
+def download_grib(remote, dst_dir: Path) -> None:
+    """Download the result of a CDS data request as a decompressed grib file.
+
+    The file is downloaded and decompressed under a temporary name, then renamed,
+    so that the aggregation stage never reads a partial file.
+    """
+    request = remote.request
+    dst_file = Path(
+        dst_dir, f"{request['year']}{request['month']}_{remote.request_id}.grib"
+    )
+    tmp_file = dst_file.with_name(f".{dst_file.name}.part")
+
+    remote.download(tmp_file.as_posix())
+    if zipfile.is_zipfile(tmp_file):
+        with zipfile.ZipFile(tmp_file, "r") as zip:
+            data = zip.read("data.grib")
+        tmp_file.write_bytes(data)
+    tmp_file.replace(dst_file)
+
+    remote.delete()
+    current_run.log_info(f"Downloaded {dst_file.name}")
+
+
+def aggregate_period(
+    daily: pl.DataFrame, frequency: str, sum_aggregation: bool
+) -> pl.DataFrame:
+    """Apply weekly or monthly aggregation to daily data."""
+    if frequency == "monthly":
+        return aggregate_per_month(
+            daily=daily, column_uid="boundary_id", sum_aggregation=sum_aggregation
+        )
+    return aggregate_per_week(
+        daily=daily,
+        column_uid="boundary_id",
+        use_epidemiological_weeks=False,
+        sum_aggregation=sum_aggregation,
+    )
+
+
+def period_start(day: date, frequency: str) -> date:
+    """Get the first day of the week (starting on monday) or month of a day."""
+    if frequency == "monthly":
+        return day.replace(day=1)
+    return day - timedelta(days=day.weekday())
+
+
+async def aggregate_stage(
+    months_queue: asyncio.Queue,
+    periods_queue: asyncio.Queue,
+    boundaries,
+    variable: str,
+    column_uid: str,
+    frequency: str,
+    input_dir: Path,
+    output_dir: Path,
+) -> None:
+    """Aggregate each downloaded month and pass completed periods to the import stage.
+
+    The last period of each month is held back until the next month is available,
+    as it may not be complete yet (ex: week overlapping two months). The first
+    period is completed with the days before the first month found in the existing
+    daily file. If they are not available, the first period is not imported.
+    Remaining periods are passed once all months have been aggregated, and
+    aggregated data files are written as in the era5_aggregate pipeline.
+    """
+    period_column = {"weekly": "week", "monthly": "month"}[frequency]
+    sum_aggregation = variable == "total_precipitation"
+
+    # daily data aggregated by previous runs
+    history = None
+    daily_fp = Path(output_dir, f"{variable}_daily.parquet")
+    if daily_fp.exists():
+        history = await asyncio.to_thread(pl.read_parquet, daily_fp)
+
+    frames = []
+    seed = None
+    window = None
+    periods = set()
+    emitted = set()
+    incomplete = set()
+
+    while (month := await months_queue.get()) is not None:
+        start, _ = month
+
+        pattern = f"{start.strftime('%Y%m')}*.grib"
+        if not any(input_dir.glob(pattern)):
+            current_run.log_warning(f"No raw data found for {start.strftime('%Y-%m')}")
+            continue
+
+        daily = await asyncio.to_thread(
+            get_daily,
+            input_dir=input_dir,
+            boundaries=boundaries,
+            variable=variable,
+            column_uid=column_uid,
+            pattern=pattern,
+        )
+        if daily.is_empty():
+            current_run.log_warning(
+                f"No valid data found for {start.strftime('%Y-%m')}"
+            )
+            continue
+
+        frames.append(daily)
+        periods.update(daily[period_column].unique().to_list())
+
+        # days before the first month, needed to complete its first period
+        if seed is None:
+            first_date = daily["date"].min()
+            seed = daily.clear()
+            if history is not None:
+                seed = pl.concat(
+                    [
+                        seed,
+                        history.filter(
+                            (pl.col("date") < first_date)
+                            & (pl.col("date") >= first_date - timedelta(days=31))
+                        ),
+                    ],
+                    how="diagonal_relaxed",
+                ).select(daily.columns)
+            window = seed
+
+            first_day = period_start(first_date, frequency)
+            covered = seed.filter(pl.col("date") >= first_day)["date"].n_unique()
+            if covered < (first_date - first_day).days:
+                first_period = daily.filter(pl.col("date") == first_date)[
+                    period_column
+                ][0]
+                incomplete.add(first_period)
+                current_run.log_warning(
+                    f"Period {first_period} will not be imported: no data available "
+                    f"before {first_date.isoformat()}"
+                )
+
+        # periods held back from previous month are fully covered by the previous
+        # month and the week before it
+        window_start = start.replace(day=1) - timedelta(days=1)
+        window_start = window_start.replace(day=1) - timedelta(days=7)
+        window = pl.concat([window, daily]).filter(pl.col("date") >= window_start)
+
+        last_period = window.filter(pl.col("date") == pl.col("date").max())[
+            period_column
+        ][0]
+
+        stats = aggregate_period(
+            daily=window, frequency=frequency, sum_aggregation=sum_aggregation
+        ).filter(
+            pl.col(period_column).is_in(periods - emitted - incomplete)
+            & (pl.col(period_column) != last_period)
+        )
+
+        current_run.log_info(
+            f"Aggregated {variable} data for {start.strftime('%Y-%m')} "
+            f"({stats[period_column].n_unique()} completed periods)"
+        )
+
+        if not stats.is_empty():
+            emitted.update(stats[period_column].unique().to_list())
+            await periods_queue.put(stats)
+
+    if frames:
+        daily = pl.concat(frames).unique(
+            subset=["boundary_id", "date"], keep="last", maintain_order=True
+        )
+        stats = aggregate_period(
+            daily=pl.concat([seed, daily]),
+            frequency=frequency,
+            sum_aggregation=sum_aggregation,
+        )
+        remaining = stats.filter(
+            pl.col(period_column).is_in(periods - emitted - incomplete)
+        )
+        if not remaining.is_empty():
+            await periods_queue.put(remaining)
+
+        await asyncio.to_thread(
+            write_aggregates,
+            daily=daily,
+            output_dir=output_dir,
+            variable=variable,
+            sum_aggregation=sum_aggregation,
+        )
+
+    await periods_queue.put(None)
+
+
+def write_aggregates(
+    daily: pl.DataFrame, output_dir: Path, variable: str, sum_aggregation: bool
+) -> None:
+    """Merge aggregated data into the daily, weekly, epi. weekly and monthly files.
+
+    Existing rows for periods not covered by the run are kept as is. Periods
+    covered by the run are recomputed from all available daily data, so that
+    periods overlapping the start date are complete. See `merge_aggregates()` for
+    the additional columns written by the era5_aggregate pipeline.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    daily_fp = Path(output_dir, f"{variable}_daily.parquet")
+    if daily_fp.exists():
+        daily_all = merge_aggregates(
+            existing=pl.read_parquet(daily_fp), df=daily, keys=["boundary_id", "date"]
+        ).sort("date", "boundary_id")
+    else:
+        daily_all = daily
+
+    daily_all.write_parquet(daily_fp)
+    current_run.add_file_output(daily_fp.as_posix())
+
+    aggregations = {
+        "weekly": ("week", "week"),
+        "epi_weekly": ("epi_week", "week"),
+        "monthly": ("month", "month"),
+    }
+
+    for frequency, (daily_column, period_column) in aggregations.items():
+        periods = daily[daily_column].unique()
+        df = daily_all.filter(pl.col(daily_column).is_in(periods))
+
+        if frequency == "monthly":
+            df = aggregate_per_month(
+                daily=df, column_uid="boundary_id", sum_aggregation=sum_aggregation
+            )
+        else:
+            df = aggregate_per_week(
+                daily=df,
+                column_uid="boundary_id",
+                use_epidemiological_weeks=frequency == "epi_weekly",
+                sum_aggregation=sum_aggregation,
+            )
+
+        fp = Path(output_dir, f"{variable}_{frequency}.parquet")
+        if fp.exists():
+            df = merge_aggregates(
+                existing=pl.read_parquet(fp),
+                df=df,
+                keys=["boundary_id", period_column],
+            )
+
+        # sort chronologically, "2012W9" must come before "2012W32"
+        if period_column == "week":
+            df = df.sort(
+                pl.col("week").str.split("W").list.get(0).cast(int),
+                pl.col("week").str.split("W").list.get(1).cast(int),
+                pl.col("boundary_id"),
+            )
+        else:
+            df = df.sort(pl.col("month").cast(int), pl.col("boundary_id"))
+
+        df.write_parquet(fp)
+        current_run.add_file_output(fp.as_posix())
+
+
+def merge_aggregates(
+    existing: pl.DataFrame, df: pl.DataFrame, keys: list[str]
+) -> pl.DataFrame:
+    """Merge recomputed rows into existing aggregated data.
+
+    Existing rows are replaced by the recomputed rows with the same keys. Columns
+    only found in the existing data (additional statistics, anomalies and z-scores
+    computed by the era5_aggregate pipeline) are kept for the recomputed rows, and
+    left empty for new rows until the era5_aggregate pipeline is run again.
+    """
+    extra = [col for col in existing.columns if col not in df.columns]
+    df = df.join(existing.select([*keys, *extra]), on=keys, how="left")
+    return pl.concat(
+        [existing.join(df, on=keys, how="anti"), df], how="diagonal_relaxed"
+    )
+
+
+async def import_stage(
+    periods_queue: asyncio.Queue,
+    dhis2: DHIS2,
+    dx_uid: str,
+    coc_uid: str,
+    existing_periods: list[str],
+    dry_run: bool,
+    output_dir: Path,
+) -> None:
+    """Push each batch of completed periods to DHIS2."""
+    while (stats := await periods_queue.get()) is not None:
+        period_column = "month" if "month" in stats.columns else "week"
+        stats = stats.select(
+            pl.col("boundary_id").alias("orgUnit"),
+            pl.col(period_column).alias("period"),
+            pl.col("mean").alias("value"),
+        ).filter(pl.col("period").is_in(existing_periods).not_())
+
+        if stats.is_empty():
+            continue
+
+        periods = (
+            stats.select(pl.col("period").unique())
+            .sort(period_sort_key())["period"]
+            .to_list()
+        )
+        period_range = f"{periods[0]}-{periods[-1]}"
+
+        payload = format_data_values(stats=stats, dx_uid=dx_uid, coc_uid=coc_uid)
+        summary = await asyncio.to_thread(
+            post_data_values,
+            dhis2=dhis2,
+            payload=payload,
+            dry_run=dry_run,
+            period_range=period_range,
+        )
+
+        # one archived run per batch, named after its period range so that it can
+        # be replayed with the era5_import_dhis2 pipeline
+        run = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
+        await asyncio.to_thread(
+            archive_payload,
+            output_dir=output_dir,
+            run=f"{run}_{period_range}",
+            payload=payload,
+            summary=summary,
+        )
+
+
+if __name__ == "__main__":
+    era5_sync()